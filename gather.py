@@ -1,15 +1,17 @@
 #!/usr/bin/python3
 
-import io
+import os
 import sys
 import shlex
 import sqlite3
 import argparse
+import atexit
+import shutil
 import tempfile
-import datetime as dt
 import subprocess as sp
-from select import select, PIPE_BUF
-from time import sleep
+import multiprocessing as mp
+from itertools import chain
+from contextlib import contextmanager
 
 
 create_sql = """
@@ -123,85 +125,214 @@ INSERT OR IGNORE INTO tests
 INSERT OR IGNORE INTO tests VALUES ('cat', '', '');
 """
 
+# Compressors that are multi-threaded by default; like the "-T0" options these
+# are never run in parallel with other tests. This includes xz which uses as
+# many threads as there are cores by default from XZ Utils 5.6 onwards
+threaded_compressors = {'pigz', 'lbzip2', 'plzip', 'xz'}
+
 query_sql = """
-WITH all_machines(machine, arch) AS (
-    VALUES (?, ?)
-),
-all_runs AS (
-    SELECT machine, arch, compressor, options, level
-    FROM all_machines CROSS JOIN tests
-)
-SELECT machine, arch, compressor, options, level FROM all_runs
-EXCEPT
-SELECT machine, arch, compressor, options, level FROM results
+SELECT :machine AS machine, :arch AS arch, t.compressor, t.options, t.level
+FROM
+    tests t
+    LEFT JOIN results r
+        ON r.machine = :machine
+        AND r.arch = :arch
+        AND r.compressor = t.compressor
+        AND r.options = t.options
+        AND r.level = t.level
+WHERE r.machine IS NULL
 """
 
 
 def get_db(filename):
-    conn = sqlite3.connect(filename)
+    # Transactions are managed explicitly; see transaction below
+    conn = sqlite3.connect(filename, isolation_level=None)
+    # Results are only committed in batches, so the default rollback journal
+    # costs little; this also folds back any WAL left by an older version of
+    # this script, keeping the database a single, portable file
+    conn.execute("PRAGMA journal_mode = DELETE")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -20000")
+    conn.execute("PRAGMA mmap_size = 268435456")
 
-    with conn:
-        try:
-            conn.executescript(create_sql)
-        except sqlite3.OperationalError as exc:
-            # Tables already exist; don't bother trying to populate
-            pass
-    with conn:
-        conn.executescript(populate_sql)
+    try:
+        conn.executescript(create_sql)
+    except sqlite3.OperationalError:
+        # Tables already exist; don't bother trying to populate
+        pass
+    conn.executescript(populate_sql)
     conn.row_factory = sqlite3.Row
     return conn
 
 
-def parse_time_mem(s):
-    duration, mem, *_ = s.split()
-    parts = duration.split(':')
-    if len(parts) == 3:
-        hrs, mins, secs = parts
-    elif len(parts) == 2:
-        hrs = '0'
-        mins, secs = parts
+@contextmanager
+def transaction(conn):
+    # Take the write lock up front rather than upgrading to it on the first
+    # write
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
     else:
-        raise ValueError('unexpected number of : separated parts')
-    if '.' in secs:
-        secs, ms = secs.split('.', 1)
-    else:
-        ms = '0'
-    elapsed = dt.timedelta(
-        hours=int(hrs),
-        minutes=int(mins),
-        seconds=int(secs),
-        microseconds=int(ms) * 10 ** (6 - len(ms)))
-    return elapsed.total_seconds(), int(mem) * 1024
-
-
-def run_test(compressor, options, level, filename, timeout=None):
-    with io.open(filename, 'rb') as input_stream, \
-            tempfile.TemporaryFile() as output_stream:
+        conn.execute("COMMIT")
+
+
+def parse_time_mem(s):
+    # time(1) writes its report last; anything before it came from the command
+    duration, mem = s.splitlines()[-1].split()
+    return float(duration), int(mem) * 1024
+
+
+def fadvise(fd, advice):
+    # posix_fadvise is only a hint, and isn't available everywhere
+    try:
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+    except AttributeError:
+        pass
+
+
+def get_mem_available():
+    # Returns the kernel's estimate of memory available (in bytes) for new
+    # allocations without swapping, or None if it can't be determined
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                key, value = line.split(':', 1)
+                if key == 'MemAvailable':
+                    return int(value.split()[0]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def cache_data(filename, copies=1, cache_dir='/dev/shm'):
+    # Copy the data to tmpfs so that every test reads it from RAM instead of
+    # re-reading it from potentially slow storage. A tmpfs copy can't be
+    # evicted, and competes with the compressors for memory, so only do this
+    # if the copy (and *copies* - 1 in-memory outputs of up to the same size)
+    # would take no more than a quarter of available memory
+    try:
+        size = os.stat(filename).st_size
+        mem_available = get_mem_available()
+        if mem_available is None or size * copies * 4 > mem_available:
+            return filename
+        if shutil.disk_usage(cache_dir).free < size * 2:
+            return filename
+        fd, cached = tempfile.mkstemp(dir=cache_dir, prefix='gather-')
+    except OSError:
+        return filename
+    os.close(fd)
+    try:
+        shutil.copyfile(filename, cached)
+    except OSError:
+        os.unlink(cached)
+        return filename
+    # The original won't be read again; don't let it crowd the page cache
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        fadvise(fd, 'POSIX_FADV_DONTNEED')
+    finally:
+        os.close(fd)
+    atexit.register(os.unlink, cached)
+    return cached
+
+
+def run_test(compressor, executable, options, level, filename, output_stream,
+             timer='time', timeout=None):
+    input_fd = os.open(filename, os.O_RDONLY)
+    try:
+        input_size = os.fstat(input_fd).st_size
         if compressor == 'cat':
             # Make an exception if it's just cat as no "compressor" would
             # actually be run in this case anyway
-            input_stream.seek(0, io.SEEK_END)
-            return (0.0, 0, 0.0, 0, input_stream.tell(), input_stream.tell())
-        cmdline = ['time', '-f', '%E %M', compressor, level]
+            return (0.0, 0, 0.0, 0, input_size, input_size)
+        fadvise(input_fd, 'POSIX_FADV_SEQUENTIAL')
+        output_stream.seek(0)
+        output_stream.truncate()
+        cmdline = [timer, '-f', '%e %M', executable, level]
         cmdline += shlex.split(options)
         print(shlex.join(cmdline), file=sys.stderr)
+        # With an absolute path to time(1) and close_fds=False, subprocess can
+        # use posix_spawn instead of fork+exec; this is safe as descriptors
+        # opened by Python are non-inheritable anyway
         result = sp.run(
-            cmdline, stdin=input_stream, stdout=output_stream, stderr=sp.PIPE,
-            check=True, timeout=timeout)
-        comp_time, comp_mem = parse_time_mem(result.stderr.decode('ascii'))
-        input_size = input_stream.tell()
-        output_size = output_stream.tell()
+            cmdline, stdin=input_fd, stdout=output_stream, stderr=sp.PIPE,
+            close_fds=False, check=True, timeout=timeout)
+        comp_time, comp_mem = parse_time_mem(result.stderr)
+        output_size = os.fstat(output_stream.fileno()).st_size
+        if output_size >= input_size:
+            # Nothing worth measuring if the "compressed" output is no smaller
+            # than the input; a decomp_max_mem of 0 marks the skipped run
+            return (comp_time, comp_mem, 0.0, 0, input_size, output_size)
         output_stream.seek(0)
-        cmdline = ['time', '-f', '%E %M', compressor, '-d']
+        cmdline = [timer, '-f', '%e %M', executable, '-d']
         print(shlex.join(cmdline), file=sys.stderr)
         result = sp.run(
             cmdline, stdin=output_stream, stdout=sp.DEVNULL, stderr=sp.PIPE,
-            check=True, timeout=timeout)
-        decomp_time, decomp_mem = parse_time_mem(result.stderr.decode('ascii'))
-        return (
-            comp_time, comp_mem,
-            decomp_time, decomp_mem,
-            input_size, output_size)
+            close_fds=False, check=True, timeout=timeout)
+        decomp_time, decomp_mem = parse_time_mem(result.stderr)
+    finally:
+        os.close(input_fd)
+    return (
+        comp_time, comp_mem,
+        decomp_time, decomp_mem,
+        input_size, output_size)
+
+
+# Each process re-uses a single scratch file for the compressed output of all
+# its tests; see init_worker
+output_stream = None
+
+
+def init_worker(in_memory=False):
+    # Like the cached data, an in-memory scratch file can't be evicted so it is
+    # only used when the data is cached too
+    global output_stream
+    if in_memory:
+        try:
+            output_stream = os.fdopen(os.memfd_create('gather-output'), 'w+b')
+            return
+        except (AttributeError, OSError):
+            pass
+    output_stream = tempfile.TemporaryFile()
+
+
+def is_threaded(compressor, options):
+    options = shlex.split(options)
+    if '-T0' in options:
+        return True
+    return compressor in threaded_compressors and '-T1' not in options
+
+
+def run_one(job):
+    (machine, arch, compressor, executable, options, level, filename,
+     timer, timeout) = job
+    key = (machine, arch, compressor, options, level)
+    try:
+        attrs = run_test(compressor, executable, options, level, filename,
+                         output_stream, timer=timer, timeout=timeout)
+    except sp.CalledProcessError:
+        return key + (False, 0.0, 0, 0.0, 0, 0, 0)
+    else:
+        return key + (True,) + attrs
+
+
+def run_all(jobs, processes=1, in_memory=False):
+    if processes > 1:
+        with mp.Pool(processes, initializer=init_worker,
+                     initargs=(in_memory,)) as pool:
+            yield from pool.imap_unordered(run_one, jobs, chunksize=1)
+    else:
+        if output_stream is None:
+            init_worker(in_memory)
+        yield from map(run_one, jobs)
+
+
+def get_arch():
+    return sp.run(['dpkg', '--print-architecture'], check=True,
+                  capture_output=True, text=True).stdout.strip()
 
 
 def main(args=None):
@@ -215,6 +346,20 @@ def main(args=None):
     parser.add_argument(
         '-t', '--timeout', default=None, type=int,
         help="The timeout for each run of a compressor (default: no timeout)")
+    parser.add_argument(
+        '-j', '--jobs', default=1, type=int,
+        help="The number of single-threaded tests to run in parallel; note "
+        "that parallel runs will skew timings, and that multi-threaded "
+        "tests are always run one at a time (default: %(default)s)")
+    parser.add_argument(
+        '-b', '--batch-size', default=50, type=int,
+        help="The number of results to gather before writing them to the "
+        "database; use 1 on machines liable to crash (default: %(default)s)")
+    parser.add_argument(
+        '-c', '--cache-data', action='store_true',
+        help="If specified (and memory permits), copy the data to /dev/shm "
+        "and keep compressed output in memory for the duration of the run, "
+        "rather than using storage for every test")
     parser.add_argument(
         '-r', '--reset', action='store_true',
         help="If specified, wipe all results for --machine from the database "
@@ -230,34 +375,62 @@ def main(args=None):
     if not config.machine:
         print(f'You must specify a --machine type', file=sys.stderr)
         return 1
-    config.arch = sp.run(['dpkg', '--print-architecture'], check=True,
-                         capture_output=True, text=True).stdout.strip()
+    config.arch = get_arch()
 
+    in_memory = False
+    if config.cache_data:
+        # Allow for the copy, plus an in-memory output per process
+        cached = cache_data(config.data, copies=config.jobs + 1)
+        in_memory = cached != config.data
+        config.data = cached
     db = get_db(config.database)
-    # Check all the compressors are installed before wasting lots of time
-    for row in db.execute("SELECT compressor FROM compressors"):
-        try:
-            sp.run([row['compressor']], stdin=sp.DEVNULL, stdout=sp.DEVNULL,
-                   check=True)
-        except (FileNotFoundError, sp.CalledProcessError):
-            print(f"Please install missing {row['compressor']}",
-                  file=sys.stderr)
+    # Check all the compressors are installed before wasting lots of time,
+    # and resolve their full paths once rather than on every execution
+    executables = {}
+    commands = chain(
+        ['time'],
+        (row['compressor']
+         for row in db.execute("SELECT compressor FROM compressors")))
+    for command in commands:
+        executable = shutil.which(command)
+        if executable is None:
+            print(f"Please install missing {command}", file=sys.stderr)
             return 1
+        executables[command] = executable
 
     if config.reset:
-        db.execute(reset_sql, (config.machine, config.arch))
-    for row in db.execute(query_sql, (config.machine, config.arch)):
-        key = (config.machine, config.arch,
-               row['compressor'], row['options'], row['level'])
-        try:
-            attrs = run_test(row['compressor'], row['options'], row['level'],
-                             config.data, timeout=config.timeout)
-        except sp.CalledProcessError:
-            results = key + (False, 0.0, 0, 0.0, 0, 0, 0)
+        with transaction(db):
+            db.execute(reset_sql, (config.machine, config.arch))
+    parallel = []
+    serial = []
+    for row in db.execute(
+            query_sql, {'machine': config.machine, 'arch': config.arch}):
+        job = (config.machine, config.arch,
+               row['compressor'], executables[row['compressor']],
+               row['options'], row['level'], config.data,
+               executables['time'], config.timeout)
+        if is_threaded(row['compressor'], row['options']):
+            serial.append(job)
         else:
-            results = key + (True,) + attrs
-        with db:
-            db.execute(insert_sql, results)
+            parallel.append(job)
+
+    cur = db.cursor()
+    pending = []
+    try:
+        for results in chain(run_all(parallel, config.jobs, in_memory),
+                             run_all(serial, in_memory=in_memory)):
+            pending.append(results)
+            if len(pending) >= config.batch_size:
+                with transaction(db):
+                    cur.executemany(insert_sql, pending)
+                pending.clear()
+    finally:
+        # Make sure whatever we gathered is written, even if a timeout or
+        # Ctrl+C cut the run short
+        if pending:
+            with transaction(db):
+                cur.executemany(insert_sql, pending)
+        db.close()
 
 
 if __name__ == '__main__':